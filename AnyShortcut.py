@@ -27,7 +27,7 @@
 import adsk.core, adsk.fusion, adsk.cam
 
 from collections import deque
-import os
+import concurrent.futures, heapq, itertools, os, secrets, time
 
 NAME = 'AnyShortcut'
 FILE_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -35,6 +35,8 @@ FILE_DIR = os.path.dirname(os.path.realpath(__file__))
 # Import relative path to avoid namespace pollution
 from .thomasa88lib import utils, events, manifest, error, timeline as libTimeLine
 utils.ReImport_List(events, manifest, error, libTimeLine, utils)
+from . import control_server, toolbar_reconcile
+utils.ReImport_List(control_server, toolbar_reconcile)
 # def newID(idVal): return 
 
 
@@ -43,13 +45,22 @@ PANEL_ID = 'thomasa88_anyShortcutPanel'
 MAIN_DROPDOWN_ID = 'thomasa88_anyShortcutMainDropdown'
 TRACKING_DROPDOWN_ID = 'thomasa88_anyShortcutDropdown'
 BUILTIN_DROPDOWN_ID = 'thomasa88_anyShortcutPremadeDropdown'
+CONTROL_EVENT_ID = 'thomasa88_anyShortcutControlEvent'
+# The control socket is opt-in: set this environment variable to the (localhost) port to listen on.
+CONTROL_PORT_ENV = 'ANYSHORTCUT_CONTROL_PORT'
+# Clients must send the contents of this file as "token" in every request. Created on first use.
+CONTROL_TOKEN_FILE = os.path.join(FILE_DIR, 'control_token.txt')
+
+VIEW_ORIENTATIONS = ['Front', 'Back', 'Top', 'Bottom', 'Left', 'Right']
+CORNER_VIEW_ORIENTATIONS = ['IsoTopRight', 'IsoTopLeft','IsoBottomRight', 'IsoBottomLeft']
+TRACKING_SEPARATOR_ID = 'thomasa88_anyShortcutDropdownSeparator'
 
 app_:adsk.core.Application = None
 ui_:adsk.core.UserInterface = None
 error_catcher_ = error.ErrorCatcher()
 events_manager_ = events.EventsManager(error_catcher_)
 manifest_ = manifest.read()
-command_starting_handler_info_ = None
+recorder_token_ = None
 
 panel_:adsk.core.ToolbarPanel = None
 tracking_dropdown_:adsk.core.DropDownControl = None
@@ -64,8 +75,13 @@ MAX_TRACK = 10
 track_count_ = 0
 tracking_ = False
 
-termination_funcs_ = []
-termination_handler_info_ = None
+control_server_:control_server.ControlServer = None
+reconciler_:toolbar_reconcile.ToolbarReconciler = None
+
+# Look At does not always terminate the way we wait for, so don't keep its clean-up around forever.
+LOOK_AT_CLEANUP_TTL = 30
+# Chained commands that never terminate should not keep the chain waiting forever.
+CHAIN_STEP_TTL = 120
 
 
 
@@ -97,27 +113,26 @@ def tryIcon(cmdDef:adsk.core.CommandDefinition, noIconPath:str = './resources/no
 
 def start_tracking():
 	global tracking_, track_count_
-	global command_starting_handler_info_
+	global recorder_token_
 	tracking_ = True
 	track_count_ = 0
-	command_starting_handler_info_ = events_manager_.add_handler(ui_.commandStarting, callback=command_starting_handler)
+	recorder_token_ = command_starting_dispatcher_.add(ALL_COMMANDS, command_starting_handler)
 	update_enable_text()
 
 def stop_tracking():
 	global tracking_
 	tracking_ = False
-	events_manager_.remove_handler(command_starting_handler_info_)
+	command_starting_dispatcher_.remove(recorder_token_)
 	update_enable_text()
 
 
-def update_enable_text():
+def enable_text():
 	if tracking_:
-		text = f'Stop recording (Auto-stop after {MAX_TRACK-track_count_} more commands)'
-		icon = './resources/stop'
-	else:
-		text = f'Start recording (Auto-stop after {MAX_TRACK} unique commands)'
-		icon = './resources/record'
-	UpdateButton(enable_cmd_def_, text, icon)
+		return f'Stop recording (Auto-stop after {MAX_TRACK-track_count_} more commands)', './resources/stop'
+	return f'Start recording (Auto-stop after {MAX_TRACK} unique commands)', './resources/record'
+
+def update_enable_text():
+	UpdateButton(enable_cmd_def_, *enable_text())
 
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -151,70 +166,220 @@ def command_starting_handler(args:adsk.core.ApplicationCommandEventArgs):
 		else: print("ADD FAIL", cmd_def.execute)
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-def on_command_terminate(command_id, termination_reason, func):
-	global termination_handler_info_
-	if not termination_handler_info_:
-		termination_handler_info_ = events_manager_.add_handler(ui_.commandTerminated, callback=command_terminated_handler)
-	termination_funcs_.append((command_id, termination_reason, func))   
-
-def command_terminated_handler(args:adsk.core.ApplicationCommandEventArgs):
-	global termination_handler_info_
-	remove_indices = []
-	for i, (command_id, termination_reason, func) in enumerate(termination_funcs_):
-		if (command_id == args.commandId and (termination_reason is None or termination_reason == args.terminationReason)):
-			remove_indices.append(i)
-			func()
-	
-	for i in reversed(remove_indices): del termination_funcs_[i]
+# Fusion calls every Python handler on every command, so instead of each feature
+# subscribing to commandStarting/commandTerminated on its own, the events are
+# subscribed once and routed on commandId.
+ALL_COMMANDS = None
+
+class CommandEventDispatcher:
+	# Entries are only expired from dispatch(), i.e. when the next command event arrives.
+	# Until then an expired entry keeps the Fusion handler attached, which is harmless.
+	def __init__(self, get_event):
+		self.get_event = get_event # ui_ is not available when the module is loaded
+		self.routes = {} # command_id -> {token: (callback, once, predicate, expired)}
+		self.tokens = {} # token -> command_id
+		self.expiries = [] # heap of (expire_time, token)
+		self.counter = itertools.count()
+		self.handler_info = None
+
+	def add(self, command_id, callback, once=False, ttl=None, predicate=None, expired=None):
+		'''Calls callback(args) when command_id (or ALL_COMMANDS) fires. Returns a token for remove().
+		One-shot entries are removed when they fire, ttl (seconds) drops entries that never fire,
+		calling expired() if given.'''
+		token = next(self.counter)
+		self.routes.setdefault(command_id, {})[token] = (callback, once, predicate, expired)
+		self.tokens[token] = command_id
+		if ttl is not None: heapq.heappush(self.expiries, (time.monotonic() + ttl, token))
+		if not self.handler_info:
+			self.handler_info = events_manager_.add_handler(self.get_event(), callback=self.dispatch)
+		return token
+
+	def remove(self, token):
+		if token not in self.tokens: return False
+		command_id = self.tokens.pop(token)
+		handlers = self.routes[command_id]
+		del handlers[token]
+		if not handlers: del self.routes[command_id]
+		# No need to have Fusion call us when nobody is listening
+		if not self.tokens:
+			events_manager_.remove_handler(self.handler_info)
+			self.handler_info = None
+			self.expiries.clear()
+		return True
+
+	def clear(self):
+		# The Fusion handler itself is removed by events_manager_.clean_up()
+		self.routes.clear()
+		self.tokens.clear()
+		self.expiries.clear()
+		self.handler_info = None
+
+	def expire(self):
+		now = time.monotonic()
+		while self.expiries and self.expiries[0][0] <= now:
+			token = heapq.heappop(self.expiries)[1]
+			if token not in self.tokens: continue
+			expired = self.routes[self.tokens[token]][token][3]
+			self.remove(token)
+			if expired:
+				with error_catcher_:
+					expired()
+
+	def dispatch(self, args:adsk.core.ApplicationCommandEventArgs):
+		if self.expiries: self.expire()
+		for command_id in (args.commandId, ALL_COMMANDS):
+			handlers = self.routes.get(command_id)
+			if not handlers: continue
+			# Copy, as callbacks may add or remove handlers
+			for token, (callback, once, predicate, expired) in list(handlers.items()):
+				if token not in self.tokens: continue
+				if predicate and not predicate(args): continue
+				if once: self.remove(token)
+				with error_catcher_:
+					callback(args)
+
+command_starting_dispatcher_ = CommandEventDispatcher(lambda: ui_.commandStarting)
+command_terminated_dispatcher_ = CommandEventDispatcher(lambda: ui_.commandTerminated)
+
+def on_command_terminate(command_id, termination_reason, func, ttl=None):
+	predicate = (lambda args: args.terminationReason == termination_reason) if termination_reason is not None else None
+	return command_terminated_dispatcher_.add(command_id, lambda args: func(), once=True, ttl=ttl, predicate=predicate)
 
-	if len(termination_funcs_) == 0:
-		events_manager_.remove_handler(termination_handler_info_)
-		termination_handler_info_ = None
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Control socket. Runs on its own thread and the Fusion API must only be used from
+# the UI thread, so requests are handed over using a custom event.
+
+def get_param(params, name, index=0):
+	# Raising ValueError makes the client get INVALID_PARAMS
+	if isinstance(params, dict) and isinstance(params.get(name), str): return params[name]
+	if isinstance(params, list) and len(params) > index and isinstance(params[index], str): return params[index]
+	raise ValueError(f'Missing parameter: {name}')
+
+def termination_reason_name(reason):
+	for name in dir(adsk.core.CommandTerminationReason):
+		if name.endswith('TerminationReason') and getattr(adsk.core.CommandTerminationReason, name) == reason:
+			return name[:-len('TerminationReason')]
+	return str(reason)
+
+def rpc_execute(params):
+	command_id = get_param(params, 'command_id')
+	cmd_def = ui_.commandDefinitions.itemById(command_id)
+	if not cmd_def: raise ValueError(f'Unknown command: {command_id}')
+	# Executing a command while another one is starting pre-empts it, so, like createChain, the
+	# result (how the command terminated) is only given when the command has terminated.
+	# The server holds back the next request until then.
+	terminated = concurrent.futures.Future()
+	def terminated_handler(args:adsk.core.ApplicationCommandEventArgs):
+		terminated.set_result(termination_reason_name(args.terminationReason))
+	def expired_handler():
+		terminated.set_exception(RuntimeError(f'{command_id} did not terminate within {CHAIN_STEP_TTL} s'))
+	token = command_terminated_dispatcher_.add(command_id, terminated_handler, once=True,
+											   ttl=CHAIN_STEP_TTL, expired=expired_handler)
+	try: cmd_def.execute()
+	except:
+		command_terminated_dispatcher_.remove(token)
+		raise
+	return terminated
+
+def rpc_recall_view(params):
+	view = get_param(params, 'view')
+	if view not in VIEW_ORIENTATIONS + CORNER_VIEW_ORIENTATIONS: raise ValueError(f'Unknown view: {view}')
+	return rpc_execute([view_command_id(view)])
+
+def control_event_handler(args:adsk.core.CustomEventArgs):
+	if control_server_: control_server_.process_pending()
+
+def read_control_token():
+	# The token allows running any command, so only the user may read it
+	try: fd = os.open(CONTROL_TOKEN_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+	except FileExistsError: os.chmod(CONTROL_TOKEN_FILE, 0o600) # Could have been created with the umask
+	else:
+		with os.fdopen(fd, 'w') as f: f.write(secrets.token_urlsafe(32))
+	with open(CONTROL_TOKEN_FILE) as f: return f.read().strip()
+
+def start_control_server():
+	global control_server_
+	port = os.environ.get(CONTROL_PORT_ENV)
+	if not port: return
+	try: port = int(port)
+	except ValueError:
+		ui_.messageBox(f'{CONTROL_PORT_ENV} must be a port number, not "{port}". The control socket is disabled.', NAME)
+		return
+	# Bind before registering the event, so that there is nothing to undo if the port is taken
+	try:
+		server = control_server.ControlServer({'execute': rpc_execute, 'recall_view': rpc_recall_view},
+											  lambda: app_.fireCustomEvent(CONTROL_EVENT_ID), read_control_token(),
+											  port, coalesced_methods=('recall_view',))
+	except OSError as e:
+		ui_.messageBox(f'Failed to start the control socket on port {port}: {e}', NAME)
+		return
+	app_.unregisterCustomEvent(CONTROL_EVENT_ID)
+	events_manager_.add_handler(app_.registerCustomEvent(CONTROL_EVENT_ID), callback=control_event_handler)
+	control_server_ = server
+	control_server_.start()
+	print(f'{NAME}: Control socket listening on {control_server_.address[0]}:{control_server_.address[1]}')
+
+def stop_control_server():
+	global control_server_
+	if not control_server_: return
+	control_server_.stop()
+	print(f'{NAME}: Control socket stopped. Stats: {control_server_.get_stats()}')
+	control_server_ = None
+	app_.unregisterCustomEvent(CONTROL_EVENT_ID)
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 @error.CatchErrors
 def run(context):
-	global app_, ui_
-	global panel_
+	global app_, ui_, reconciler_
 	app_,ui_ = utils.AppObjects()
+	reconciler_ = toolbar_reconcile.ToolbarReconciler(ui_.commandDefinitions, FILE_DIR)
+	build_toolbar()
+	print(f'{NAME}: Toolbar reconciled ({reconciler_.report()})')
+	start_control_server()
+
+def build_toolbar():
+	global panel_
 	#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 	# Add the command to the tab.
 	panels = ui_.allToolbarTabs.itemById('ToolsTab').toolbarPanels
 
-	ifDelete(panels.itemById(PANEL_ID))
-	panel_ = panels.add(PANEL_ID, f'{NAME}')
+	panel_ = reconciler_.panel(panels, PANEL_ID, f'{NAME}')
 	add_builtin_dropdown(panel_)
 	#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 	global tracking_dropdown_
-	ifDelete(panel_.controls.itemById(TRACKING_DROPDOWN_ID))
-	tracking_dropdown_ = panel_.controls.addDropDown(f'Command Recorder',
-														'./resources/tracker',
-														TRACKING_DROPDOWN_ID)
+	tracking_dropdown_ = reconciler_.dropdown(panel_, TRACKING_DROPDOWN_ID,
+														f'Command Recorder',
+														'./resources/tracker')
+	reconciler_.prune(panel_)
 	#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 	global enable_cmd_def_
-	ifDelete(ui_.commandDefinitions.itemById(ENABLE_CMD_DEF_ID))
 	# Cannot get checkbox to play nicely (won't update without collapsing
 	# the menu and the default checkbox icon is not showing...).  See checkbox-test branch.
-	enable_cmd_def_ = ui_.commandDefinitions.addButtonDefinition(
-												ENABLE_CMD_DEF_ID,
-												f'Loading...', '')
-	update_enable_text()
+	# Reconcile with the text it is going to show, so that a reload does not rename it back and forth
+	text, icon = enable_text()
+	enable_cmd_def_ = reconciler_.button_definition(ENABLE_CMD_DEF_ID, text, '', icon)
 	events_manager_.add_handler(event=enable_cmd_def_.commandCreated, callback=enable_cmd_def__created_handler)
 	
 	#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-	enable_control:adsk.core.CommandControl = tracking_dropdown_.controls.addCommand(enable_cmd_def_)
-	enable_control.isPromoted = True
-	enable_control.isPromotedByDefault = True
-	tracking_dropdown_.controls.addSeparator()
+	reconciler_.command(tracking_dropdown_, enable_cmd_def_, promote=True)
+	reconciler_.separator(tracking_dropdown_, TRACKING_SEPARATOR_ID)
+	# Recorded commands are not kept over a reload
+	reconciler_.prune(tracking_dropdown_)
 
 
 
 @error.CatchErrors
 def stop(context):
+	global tracking_
+	tracking_ = False
+	stop_control_server()
 	events_manager_.clean_up()
-	deleteAll(tracking_dropdown_, builtin_dropdown_, panel_)
-	# Need to delete children?
+	command_starting_dispatcher_.clear()
+	command_terminated_dispatcher_.clear()
+	# Hide instead of deleting, so that run() can pick up the existing controls and
+	# Fusion keeps the promoted/pinned state. Commands are re-attached on the next run().
+	if panel_ and panel_.isValid: panel_.isVisible = False
 
 
 
@@ -237,7 +402,7 @@ def look_at_sketch_handler(args: adsk.core.CommandCreatedEventArgs):
 		executeCommand('LookAtCommand')
 		# We must give the Look At command time to run. This seems to imitate the way that Fusion does it.
 		# Using lambda to get fresh/valid instance of activeSelections at the end of the wait.
-		on_command_terminate('LookAtCommand', adsk.core.CommandTerminationReason.CancelledTerminationReason, lambda: ui_.activeSelections.clear())
+		on_command_terminate('LookAtCommand', adsk.core.CommandTerminationReason.CancelledTerminationReason, lambda: ui_.activeSelections.clear(), ttl=LOOK_AT_CLEANUP_TTL)
 
 def look_at_sketch_or_selected_handler(args: adsk.core.CommandCreatedEventArgs):
 	# Look at is usually not added to the history - skip execution handler.
@@ -411,37 +576,15 @@ def createInputsHandler():
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 def createChain(*commandIds):
-	startingInfo = None
-	terminatedInfo = None
-
-	chainId = None
-	commandOrder = []
-	currentCommand = None
 	def initialCreate(args: adsk.core.CommandCreatedEventArgs):
-		nonlocal startingInfo, terminatedInfo,chainId,commandOrder
-		commandOrder = list(commandIds)
-		chainId = args.command.parentCommandDefinition.id
-		startingInfo = events_manager_.add_handler(ui_.commandStarting, callback=commandStartingHandler)
-		terminatedInfo = events_manager_.add_handler(ui_.commandTerminated, callback=commandTerminatedHandler)
-		executeCommand(commandOrder[0])
+		runNext(list(commandIds))
 	#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-	def commandStartingHandler(args:adsk.core.ApplicationCommandEventArgs):
-		nonlocal currentCommand
-		if args.commandId == chainId:return
-		if args.commandId != commandOrder[0]: return
+	def runNext(commandOrder):
+		if len(commandOrder) == 0: return
 		currentCommand = commandOrder.pop(0)
-
-	def commandTerminatedHandler(args:adsk.core.ApplicationCommandEventArgs):
-		if currentCommand is None: return
-		if len(commandOrder) == 0: return removeQueue()
-		if args.commandId != currentCommand: return
-		executeCommand(commandOrder[0])
-	#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-	def removeQueue():
-		nonlocal currentCommand,startingInfo,terminatedInfo
-		events_manager_.remove_handler(startingInfo)
-		events_manager_.remove_handler(terminatedInfo)
-		startingInfo=terminatedInfo=currentCommand= None
+		# Continue with the next command once this one has finished
+		command_terminated_dispatcher_.add(currentCommand, lambda args: runNext(commandOrder), once=True, ttl=CHAIN_STEP_TTL)
+		executeCommand(currentCommand)
 	return initialCreate
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -464,6 +607,10 @@ def create_roll_history_handler(move_function_name):
 		events_manager_.add_handler(args.command.execute, callback=execute_handler)
 	return created_handler
 
+def view_command_id(view):
+	if view in CORNER_VIEW_ORIENTATIONS: return 'thomasa88_anyShortcutBuiltinCornerViewList' + view
+	return 'thomasa88_anyShortcutBuiltinView' + view
+
 def create_view_orientation_handler(view_orientation_name, smooth=False, fitView = False):
 	def created_handler(args: adsk.core.CommandCreatedEventArgs):
 		# We don't want undo history, so no execute handler
@@ -475,22 +622,111 @@ def create_view_orientation_handler(view_orientation_name, smooth=False, fitView
 		app_.activeViewport.camera = camera_copy
 	return created_handler
 
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# The world axis view orientations are not of much use when sketching on an inclined
+# plane, so these views are relative to the active sketch, or the selected planar face.
+
+ISO = 3 ** -0.5
+# (eye direction from the target, up vector) in the local frame, where z is the sketch/face normal.
+LOCAL_VIEW_POSES = {
+	'Front': ((0, -1, 0), (0, 0, 1)),
+	'Back': ((0, 1, 0), (0, 0, 1)),
+	'Top': ((0, 0, 1), (0, 1, 0)),
+	'Bottom': ((0, 0, -1), (0, -1, 0)),
+	'Left': ((-1, 0, 0), (0, 0, 1)),
+	'Right': ((1, 0, 0), (0, 0, 1)),
+	'IsoTopRight': ((ISO, -ISO, ISO), (0, 0, 1)),
+	'IsoTopLeft': ((-ISO, -ISO, ISO), (0, 0, 1)),
+	'IsoBottomRight': ((ISO, -ISO, -ISO), (0, 0, 1)),
+	'IsoBottomLeft': ((-ISO, -ISO, -ISO), (0, 0, 1)),
+}
+# (frame key, {view: (eye direction, up vector)}) for the last edit object/face
+local_view_cache_ = (None, None)
+
+def normalized(vector:adsk.core.Vector3D):
+	vector = vector.copy()
+	vector.normalize()
+	return vector.asArray()
+
+def get_local_frame_key():
+	'''Returns (key, source) for the active sketch or the selected planar face, or (None, None).
+	The key is cheap to get and changes when the object, or its placement, changes. The axes
+	are only derived from the source, with local_frame_axes(), when the key is not cached.'''
+	edit_object = app_.activeEditObject
+	if isinstance(edit_object, adsk.fusion.Sketch):
+		context = edit_object.assemblyContext
+		return (edit_object.entityToken, edit_object.transform.asArray(),
+				context.transform2.asArray() if context else None), edit_object
+
+	if ui_.activeSelections.count == 1:
+		face = ui_.activeSelections.item(0).entity
+		if isinstance(face, adsk.fusion.BRepFace):
+			plane = face.geometry
+			if isinstance(plane, adsk.core.Plane):
+				return (face.entityToken, plane.origin.asArray(), plane.normal.asArray()), face
+	return None, None
+
+def local_frame_axes(source):
+	'''Returns the (x, y, z) axes of a sketch or planar face, where z is the normal.'''
+	if isinstance(source, adsk.fusion.Sketch):
+		matrix = source.transform
+		if source.assemblyContext:
+			matrix.transformBy(source.assemblyContext.transform2)
+		origin, x, y, z = matrix.getAsCoordinateSystem()
+		return normalized(x), normalized(y), normalized(z)
+
+	# The plane normal does not have to point out of the body, the evaluator's does.
+	_, z = source.evaluator.getNormalAtPoint(source.pointOnFace)
+	y = z.crossProduct(source.geometry.uDirection)
+	x = y.crossProduct(z)
+	return normalized(x), normalized(y), normalized(z)
+
+def compute_local_views(axes):
+	'''Transforms all poses to world space in one matrix product: [x y z] * [eye... up...].'''
+	columns = [eye for eye, up in LOCAL_VIEW_POSES.values()] + [up for eye, up in LOCAL_VIEW_POSES.values()]
+	rows = list(zip(*axes))
+	world = [tuple(sum(r * c for r, c in zip(row, column)) for row in rows) for column in columns]
+	count = len(LOCAL_VIEW_POSES)
+	return {view: (world[i], world[count + i]) for i, view in enumerate(LOCAL_VIEW_POSES)}
+
+def create_local_view_handler(view):
+	# Without a sketch or face, fall back to the world axis view
+	world_view_handler = create_view_orientation_handler(view)
+	def created_handler(args: adsk.core.CommandCreatedEventArgs):
+		global local_view_cache_
+		key, source = get_local_frame_key()
+		if key is None: return world_view_handler(args)
+		args.command.isRepeatable = False
+
+		if local_view_cache_[0] != key: local_view_cache_ = (key, compute_local_views(local_frame_axes(source)))
+		eye_direction, up = local_view_cache_[1][view]
+
+		# Keep the target and the distance to it, only rotate around it
+		camera_copy = app_.activeViewport.camera
+		target = camera_copy.target.asArray()
+		distance = camera_copy.eye.distanceTo(camera_copy.target)
+		camera_copy.eye = adsk.core.Point3D.create(*[t + d * distance for t, d in zip(target, eye_direction)])
+		camera_copy.upVector = adsk.core.Vector3D.create(*up)
+		app_.activeViewport.camera = camera_copy
+	return created_handler
+
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 def add_builtin_dropdown(parent:adsk.core.ToolbarPanel):
 	global builtin_dropdown_
-	ifDelete(parent.controls.itemById(BUILTIN_DROPDOWN_ID))
-	builtin_dropdown_ = parent.controls.addDropDown(f'Built-in Commands', './resources/builtin', BUILTIN_DROPDOWN_ID)
+	builtin_dropdown_ = reconciler_.dropdown(parent, BUILTIN_DROPDOWN_ID, f'Built-in Commands', './resources/builtin')
 
-	def create(controls:adsk.core.ToolbarControls, cmd_def_id, text, tooltip, resource_folder, handler):
+	def create(parent:adsk.core.DropDownControl, cmd_def_id, text, tooltip, resource_folder, handler):
 		# The cmd_def_id must never change during development of the add-in as users hotkeys will map to the command definition ID.
-		ifDelete(ui_.commandDefinitions.itemById(cmd_def_id))
-		cmd_def = ui_.commandDefinitions.addButtonDefinition( cmd_def_id, text, tooltip, resource_folder)
+		cmd_def = reconciler_.button_definition(cmd_def_id, text, tooltip, resource_folder)
 		checkIcon(cmd_def) # Must have icon for the assign shortcut menu to appear
 		events_manager_.add_handler(cmd_def.commandCreated, callback=handler)
-		return controls.addCommand(cmd_def)
+		return reconciler_.command(parent, cmd_def)
 
-	create(builtin_dropdown_.controls,
+	def createDropDown(parent:adsk.core.DropDownControl, text, resource_folder, dropdown_id):
+		return reconciler_.dropdown(parent, dropdown_id, text, resource_folder)
+
+	create(builtin_dropdown_,
 			'thomasa88_anyShortcutListLookAtSketchCommand',
 			'Look At Sketch',
 			'Rotates the view to look at the sketch currently being edited. ' + 
@@ -498,7 +734,7 @@ def add_builtin_dropdown(parent:adsk.core.ToolbarPanel):
 			'./resources/lookatsketch',
 			look_at_sketch_handler)
 
-	create(builtin_dropdown_.controls,
+	create(builtin_dropdown_,
 			'thomasa88_anyShortcutListLookAtSketchOrSelectedCommand',
 			'Look At Selected or Sketch',
 			'Rotates the view to look at, in priority order:\n' +
@@ -507,7 +743,7 @@ def add_builtin_dropdown(parent:adsk.core.ToolbarPanel):
 			'./resources/lookatselectedorsketch',
 			look_at_sketch_or_selected_handler)
 
-	create(builtin_dropdown_.controls,
+	create(builtin_dropdown_,
 			'thomasa88_anyShortcutListActivateContainingOrComponentCommand',
 			'Activate (containing) Component',
 			'Activates the selected component. If no component is selected, '
@@ -517,7 +753,7 @@ def add_builtin_dropdown(parent:adsk.core.ToolbarPanel):
 
 	# For some reason, repeat captured using the tracking only works when clicking,
 	# not with a keyboard shortcut.
-	create(builtin_dropdown_.controls,
+	create(builtin_dropdown_,
 			'thomasa88_anyShortcutBuiltinRepeatCommand',
 			'Repeat Last Command',
 			'',
@@ -525,28 +761,28 @@ def add_builtin_dropdown(parent:adsk.core.ToolbarPanel):
 			repeat_command_handler)
 	
 	#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-	create(builtin_dropdown_.controls,
+	create(builtin_dropdown_,
 			'thomasa88_anyShortcutBuiltinAlignView',
 			'Align The Cameras Up',
 			'',
 			'./resources/repeat',
 			alignViewHandler)
 
-	create(builtin_dropdown_.controls,
+	create(builtin_dropdown_,
 			'thomasa88_anyShortcutBuiltinChangeView',
 			'Change the view Forwards',
 			'',
 			'./resources/activate',
 			changeViewAxis)
 
-	create(builtin_dropdown_.controls,
+	create(builtin_dropdown_,
 			'thomasa88_anyShortcutBuiltinChangeAlignView',
 			'Change and align the view axis',
 			'',
 			'./resources/timelineforward',
 			createChain('thomasa88_anyShortcutBuiltinChangeView', 'thomasa88_anyShortcutBuiltinAlignView'))
 
-	create(builtin_dropdown_.controls,
+	create(builtin_dropdown_,
 			'tion_buttonTest',
 			'CommandChaining',
 			'',
@@ -554,37 +790,37 @@ def add_builtin_dropdown(parent:adsk.core.ToolbarPanel):
 			createInputsHandler())
 	
 	#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-	timeline_dropdown:adsk.core.DropDownControl = builtin_dropdown_.controls.addDropDown('Timeline', './resources/timeline', 'thomasa88_anyShortcutBuiltinTimelineList')
+	timeline_dropdown:adsk.core.DropDownControl = createDropDown(builtin_dropdown_, 'Timeline', './resources/timeline', 'thomasa88_anyShortcutBuiltinTimelineList')
 
-	create(timeline_dropdown.controls,
+	create(timeline_dropdown,
 			'thomasa88_anyShortcutListRollToBeginning',
 			'Roll History Marker to Beginning',
 			'',
 			'./resources/timelinebeginning',
 			create_roll_history_handler('moveToBeginning'))
 
-	create(timeline_dropdown.controls,
+	create(timeline_dropdown,
 			'thomasa88_anyShortcutListRollBack',
 			'Roll History Marker Back',
 			'',
 			'./resources/timelineback',
 			create_roll_history_handler('moveToPreviousStep'))
 	
-	create(timeline_dropdown.controls,
+	create(timeline_dropdown,
 			'thomasa88_anyShortcutListRollForward',
 			'Roll History Marker Forward',
 			'',
 			'./resources/timelineforward',
 			create_roll_history_handler('movetoNextStep'))
 
-	create(timeline_dropdown.controls,
+	create(timeline_dropdown,
 			'thomasa88_anyShortcutListRollToEnd',
 			'Roll History Marker to End',
 			'',
 			'./resources/timelineend',
 			create_roll_history_handler('moveToEnd'))
 
-	create(timeline_dropdown.controls,
+	create(timeline_dropdown,
 			'thomasa88_anyShortcutListHistoryPlay',
 			'Play History from Current Position',
 			'',
@@ -592,23 +828,34 @@ def add_builtin_dropdown(parent:adsk.core.ToolbarPanel):
 			create_roll_history_handler('play'))
 
 	#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-	view_dropdown:adsk.core.DropDownControl = builtin_dropdown_.controls.addDropDown('View Orientation', './resources/viewfront', 'thomasa88_anyShortcutBuiltinViewList')
-	for view in ['Front', 'Back', 'Top', 'Bottom', 'Left', 'Right']:
-		create(view_dropdown.controls,
-			'thomasa88_anyShortcutBuiltinView' + view,
+	view_dropdown:adsk.core.DropDownControl = createDropDown(builtin_dropdown_, 'View Orientation', './resources/viewfront', 'thomasa88_anyShortcutBuiltinViewList')
+	for view in VIEW_ORIENTATIONS:
+		create(view_dropdown,
+			view_command_id(view),
 			'View ' + view, '',
 			'./resources/view' + view.lower(),
 			create_view_orientation_handler(view))
 		
-	view_corner_dropdown:adsk.core.DropDownControl = builtin_dropdown_.controls.addDropDown('View Corner', './resources/viewisotopright', 'thomasa88_anyShortcutBuiltinCornerViewList')
-	for view in ['IsoTopRight', 'IsoTopLeft','IsoBottomRight', 'IsoBottomLeft' ]:
-		create(view_corner_dropdown.controls,
-			'thomasa88_anyShortcutBuiltinCornerViewList' + view,
+	view_corner_dropdown:adsk.core.DropDownControl = createDropDown(builtin_dropdown_, 'View Corner', './resources/viewisotopright', 'thomasa88_anyShortcutBuiltinCornerViewList')
+	for view in CORNER_VIEW_ORIENTATIONS:
+		create(view_corner_dropdown,
+			view_command_id(view),
 			'View ' + view.strip('Iso'), '',
 			'./resources/view' + view.lower(),
 			create_view_orientation_handler(view))
 
+	local_view_dropdown:adsk.core.DropDownControl = createDropDown(builtin_dropdown_, 'Sketch/Face View', './resources/lookatsketch', 'thomasa88_anyShortcutBuiltinLocalViewList')
+	for view in LOCAL_VIEW_POSES:
+		create(local_view_dropdown,
+			'thomasa88_anyShortcutBuiltinLocalView' + view,
+			'Sketch/Face View ' + view.replace('Iso', ''),
+			'Orients the view relative to the sketch being edited or the selected planar face. ' +
+			'Uses the regular view if there is neither.',
+			'./resources/view' + view.lower(),
+			create_local_view_handler(view))
 
+	for dropdown in (builtin_dropdown_, timeline_dropdown, view_dropdown, view_corner_dropdown, local_view_dropdown):
+		reconciler_.prune(dropdown, delete_definitions=True)
 
 
 
@@ -645,21 +892,21 @@ def add_builtin_dropdown(parent:adsk.core.ToolbarPanel):
 # 		return controls.addCommand(cmd_def)
 
 # 	#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-# 	create(builtin_dropdown_.controls,
+# 	create(builtin_dropdown_,
 # 			'zxynine_anyMacroBuiltinAlignView',
 # 			'Align The Camera',
 # 			'',
 # 			'./resources/repeat',
 # 			alignViewHandler)
 
-# 	create(builtin_dropdown_.controls,
+# 	create(builtin_dropdown_,
 # 			'zxynine_anyMacroBuiltinChangeView',
 # 			'Change the view axis',
 # 			'',
 # 			'./resources/activate',
 # 			changeViewAxis)
 
-# 	create(builtin_dropdown_.controls,
+# 	create(builtin_dropdown_,
 # 			'zxynine_anyMacroBuiltinChangeAlignView',
 # 			'Change and align the view axis',
 # 			'',
@@ -0,0 +1,255 @@
+# This file is part of AnyShortcut, a Fusion 360 add-in for assigning
+# shortcuts to the last run commands.
+#
+# Copyright (c) 2020 Thomas Axelsson
+#
+# See AnyShortcut.py for the license (MIT).
+
+# Local JSON-RPC 2.0 control socket, to trigger commands from macro pads and scripts.
+# One request (or batch array) per line, one response per line. Every request must
+# carry the shared secret in a "token" member. The connection is closed on anything
+# that is not a valid, authorized request, so that e.g. a web page posting to
+# localhost cannot smuggle a request in the body of an HTTP request.
+#
+# This module does not touch the Fusion API, so that it can be run headless.
+# Requests are queued on the server thread and the `notify` callback is called to
+# get `process_pending()` run on the UI thread (through a Fusion custom event).
+# Requests are run one at a time, in order. A method that starts something that
+# finishes later (e.g. a command) returns a Future, and the next request is not run
+# until it is done.
+
+import hmac, itertools, json, socket, socketserver, threading, time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+SERVER_BUSY = -32000
+REQUEST_TIMEOUT = -32001
+UNAUTHORIZED = -32002
+
+# Errors after which the connection is closed, as the client is not speaking our protocol
+FATAL_ERRORS = (PARSE_ERROR, INVALID_REQUEST, UNAUTHORIZED)
+
+class RpcError(Exception):
+	def __init__(self, code, message):
+		super().__init__(message)
+		self.code = code
+
+
+class _Handler(socketserver.StreamRequestHandler):
+	def handle(self):
+		control = self.server.control
+		control.connections.add(self.connection)
+		try:
+			for line in self.rfile:
+				line = line.strip()
+				if not line: continue
+				response, keep_open = control.handle_line(line)
+				if response is not None:
+					self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+				if not keep_open: break
+		except OSError: pass # Client went away or we are shutting down
+		finally: control.connections.discard(self.connection)
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+	allow_reuse_address = True
+	daemon_threads = True
+
+
+class ControlServer:
+	'''`methods` maps method names to callables taking the params and running on the UI thread.
+	They return the result, or a Future for it, which holds back the following requests. Requests for `coalesced_methods` (which must be idempotent) that are already waiting for the
+	UI thread are merged into one call, but never within the same batch. When more than
+	`max_pending` requests are waiting, new ones are rejected (SERVER_BUSY).'''
+	def __init__(self, methods, notify, token, port=0, host='127.0.0.1', coalesced_methods=(),
+				 max_pending=64, timeout=5.0):
+		if not token: raise ValueError('A token is required')
+		self.methods = methods
+		self.notify = notify
+		self.token = token
+		self.coalesced_methods = set(coalesced_methods)
+		self.max_pending = max_pending
+		self.timeout = timeout
+		self.lock = threading.Lock()
+		self.pending = OrderedDict() # (method, params json[, unique number]) -> Future
+		self.unique = itertools.count()
+		self.notified = False
+		self.running = None # Future of the request that is waiting for its method's Future
+		self.closed = False
+		self.connections = set()
+		self.stats = {'requests': 0, 'coalesced': 0, 'rejected': 0, 'timeouts': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+		self.server = _TCPServer((host, port), _Handler, bind_and_activate=True)
+		self.server.control = self
+		self.address = self.server.server_address
+		self.thread = None
+
+	def start(self):
+		# Short poll interval, as stop() has to wait for it
+		self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.1},
+										name='AnyShortcut control server', daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		with self.lock:
+			self.closed = True
+			pending, self.pending = self.pending, OrderedDict()
+			running, self.running = self.running, None
+		for future in pending.values():
+			if future.set_running_or_notify_cancel():
+				future.set_exception(RpcError(INTERNAL_ERROR, 'Server is shutting down'))
+		if running and not running.done():
+			running.set_exception(RpcError(INTERNAL_ERROR, 'Server is shutting down'))
+		# shutdown() waits for serve_forever() to stop, which never happens if it was never started
+		if self.thread: self.server.shutdown()
+		self.server.server_close()
+		# Unblock handler threads that are waiting for the client to send more. Only the read
+		# side, so that the answers to the requests failed above still get written.
+		for connection in list(self.connections):
+			try: connection.shutdown(socket.SHUT_RD)
+			except OSError: pass
+		if self.thread: self.thread.join(self.timeout)
+		self.thread = None
+
+	#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+	# Server thread
+
+	def handle_line(self, line):
+		'''Returns (response, keep_open).'''
+		# Only JSON is accepted. This also throws out HTTP request lines and headers.
+		if line[:1] not in (b'{', b'['): return error_response(None, PARSE_ERROR, 'Parse error'), False
+		try: message = json.loads(line)
+		except ValueError: return error_response(None, PARSE_ERROR, 'Parse error'), False
+
+		if isinstance(message, list):
+			if not message: return error_response(None, INVALID_REQUEST, 'Empty batch'), False
+			# Queue the whole batch before waiting, so that it is run in one go on the UI thread
+			batch_keys = set()
+			waiting = [self.submit(request, batch_keys) for request in message]
+			responses = [self.wait(*entry) for entry in waiting]
+			keep_open = not any(isinstance(entry[-1], RpcError) and entry[-1].code in FATAL_ERRORS for entry in waiting)
+			return [response for response in responses if response is not None] or None, keep_open
+		entry = self.submit(message, set())
+		keep_open = not (isinstance(entry[-1], RpcError) and entry[-1].code in FATAL_ERRORS)
+		return self.wait(*entry), keep_open
+
+	def submit(self, request, batch_keys):
+		start = time.perf_counter()
+		if not isinstance(request, dict) or not isinstance(request.get('method'), str):
+			return (start, None, False, RpcError(INVALID_REQUEST, 'Invalid request'))
+		request_id = request.get('id')
+		is_notification = 'id' not in request
+		token = request.get('token')
+		if not isinstance(token, str) or not hmac.compare_digest(token.encode('utf-8'), self.token.encode('utf-8')):
+			return (start, request_id, False, RpcError(UNAUTHORIZED, 'Invalid token'))
+		method = request['method']
+		params = request.get('params', {})
+
+		if method == 'ping': return (start, request_id, is_notification, 'pong')
+		if method == 'stats': return (start, request_id, is_notification, self.get_stats())
+		if method not in self.methods:
+			return (start, request_id, is_notification, RpcError(METHOD_NOT_FOUND, f'Method not found: {method}'))
+
+		key = (method, json.dumps(params, sort_keys=True))
+		if method not in self.coalesced_methods or key in batch_keys:
+			key += (next(self.unique),)
+		batch_keys.add(key)
+		with self.lock:
+			if self.closed: return (start, request_id, is_notification, RpcError(INTERNAL_ERROR, 'Server is shutting down'))
+			future = self.pending.get(key)
+			if future:
+				self.stats['coalesced'] += 1
+			elif len(self.pending) >= self.max_pending:
+				self.stats['rejected'] += 1
+				return (start, request_id, is_notification, RpcError(SERVER_BUSY, 'Server busy'))
+			else:
+				future = self.pending[key] = Future()
+			fire = not self.notified
+			self.notified = True
+		if fire:
+			try: self.notify()
+			except Exception as e:
+				# Let the next request try again, instead of everyone waiting for an event that never comes
+				with self.lock: self.notified = False
+				if future.cancel():
+					return (start, request_id, is_notification, RpcError(INTERNAL_ERROR, f'Failed to notify Fusion: {e}'))
+		return (start, request_id, is_notification, future)
+
+	def wait(self, start, request_id, is_notification, result):
+		if isinstance(result, Future):
+			try: result = result.result(self.timeout)
+			except FutureTimeoutError:
+				if result.cancel():
+					# Not started, so it will be skipped by process_pending()
+					with self.lock: self.stats['timeouts'] += 1
+					result = RpcError(REQUEST_TIMEOUT, 'Timed out waiting for Fusion')
+				else:
+					result = self.wait_started(result)
+			except Exception as e: result = to_rpc_error(e)
+		self.record_latency(start)
+		if is_notification: return None
+		if isinstance(result, RpcError): return error_response(request_id, result.code, str(result))
+		return {'jsonrpc': '2.0', 'id': request_id, 'result': result}
+
+	def wait_started(self, future):
+		# The UI thread picked it up just as we timed out, or it is waiting for e.g. a command
+		# to terminate. Give it another timeout to report the real outcome.
+		try: return future.result(self.timeout)
+		except FutureTimeoutError: return RpcError(REQUEST_TIMEOUT, 'Still running in Fusion')
+		except Exception as e: return to_rpc_error(e)
+
+	def record_latency(self, start):
+		elapsed_ms = (time.perf_counter() - start) * 1000
+		with self.lock:
+			self.stats['requests'] += 1
+			self.stats['total_ms'] += elapsed_ms
+			self.stats['max_ms'] = max(self.stats['max_ms'], elapsed_ms)
+
+	def get_stats(self):
+		with self.lock:
+			stats = dict(self.stats)
+		stats['mean_ms'] = stats['total_ms'] / stats['requests'] if stats['requests'] else 0.0
+		return stats
+
+	#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+	# UI thread
+
+	def process_pending(self):
+		with self.lock: self.notified = False
+		while True:
+			with self.lock:
+				if self.running or not self.pending: return
+				key, future = self.pending.popitem(last=False)
+			# Skip requests that the client has given up on
+			if not future.set_running_or_notify_cancel(): continue
+			try: result = self.methods[key[0]](json.loads(key[1]))
+			except Exception as e:
+				future.set_exception(e)
+				continue
+			if not isinstance(result, Future):
+				future.set_result(result)
+				continue
+			# Hold back the rest until it is done. Continues on the thread that completes it.
+			with self.lock: self.running = future
+			result.add_done_callback(lambda done, future=future: self.resume(future, done))
+			return
+
+	def resume(self, future, done):
+		with self.lock:
+			if self.running is not future: return # Failed by stop()
+			self.running = None
+		try: future.set_result(done.result())
+		except Exception as e: future.set_exception(e)
+		self.process_pending()
+
+
+def to_rpc_error(e):
+	if isinstance(e, RpcError): return e
+	if isinstance(e, ValueError): return RpcError(INVALID_PARAMS, str(e))
+	return RpcError(INTERNAL_ERROR, f'{type(e).__name__}: {e}')
+
+def error_response(request_id, code, message):
+	return {'jsonrpc': '2.0', 'id': request_id, 'error': {'code': code, 'message': message}}
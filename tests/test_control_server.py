@@ -0,0 +1,220 @@
+# Headless tests for the control socket, using a local client and a fake UI thread.
+# Run with: python -m unittest discover tests  (or python -m pytest tests)
+
+import concurrent.futures, json, os, socket, sys, threading, time, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import control_server
+
+TOKEN = 'test-token'
+
+class Client:
+	def __init__(self, address):
+		self.socket = socket.create_connection(address, timeout=10)
+		self.file = self.socket.makefile('rwb')
+
+	def send_raw(self, data):
+		self.file.write(data)
+		self.file.flush()
+		line = self.file.readline()
+		return json.loads(line) if line else None
+
+	def call(self, message):
+		return self.send_raw(json.dumps(message).encode('utf-8') + b'\n')
+
+	def close(self):
+		self.file.close()
+		self.socket.close()
+
+def request(request_id, method, params=None, token=TOKEN):
+	message = {'jsonrpc': '2.0', 'id': request_id, 'method': method, 'token': token}
+	if params is not None: message['params'] = params
+	return message
+
+
+class ControlServerTest(unittest.TestCase):
+	def setUp(self):
+		self.calls = []
+		self.hold = False # Keep executed commands running until terminate() is called
+		self.running = []
+		self.notified = threading.Event()
+		self.server = self.make_server()
+		self.server.start()
+		self.pool = concurrent.futures.ThreadPoolExecutor(4)
+		self.clients = []
+
+	def tearDown(self):
+		self.server.stop()
+		for client in self.clients: client.close()
+		self.pool.shutdown()
+
+	def make_server(self, **kwargs):
+		def execute(params):
+			# Like AnyShortcut.rpc_execute, the result is given when the command terminates
+			if 'command_id' not in params: raise ValueError('Missing parameter: command_id')
+			self.calls.append(params['command_id'])
+			terminated = concurrent.futures.Future()
+			if self.hold: self.running.append(terminated)
+			else: terminated.set_result('Completed')
+			return terminated
+		def recall_view(params):
+			self.calls.append('view ' + params['view'])
+			return True
+		options = dict(coalesced_methods=('recall_view',), max_pending=3, timeout=1.0)
+		options.update(kwargs)
+		return control_server.ControlServer({'execute': execute, 'recall_view': recall_view},
+											self.notified.set, TOKEN, **options)
+
+	def client(self):
+		client = Client(self.server.address)
+		self.clients.append(client)
+		return client
+
+	def terminate(self, reason='Completed'):
+		# Fake commandTerminated, on the fake UI thread
+		self.running.pop(0).set_result(reason)
+
+	def process_when_notified(self, expected_pending=1):
+		# Fake UI thread: wait for the custom event and for the requests to queue up
+		self.assertTrue(self.notified.wait(5))
+		deadline = time.time() + 5
+		while len(self.server.pending) < expected_pending and time.time() < deadline: time.sleep(0.01)
+		self.notified.clear()
+		self.server.process_pending()
+
+	def test_ping_does_not_need_ui_thread(self):
+		self.assertEqual(self.client().call(request(1, 'ping'))['result'], 'pong')
+
+	def test_batched_execute_waits_for_termination(self):
+		self.hold = True
+		client = self.client()
+		reply = self.pool.submit(client.call, [request(1, 'execute', {'command_id': 'A'}),
+											   request(2, 'execute', {'command_id': 'B'})])
+		self.process_when_notified(2)
+		# B must not pre-empt A
+		self.assertEqual(self.calls, ['A'])
+		self.terminate('Cancelled')
+		self.assertEqual(self.calls, ['A', 'B'])
+		self.assertFalse(reply.done())
+		self.terminate()
+		self.assertEqual([r['result'] for r in reply.result(5)], ['Cancelled', 'Completed'])
+
+	def test_requests_wait_for_running_command(self):
+		self.hold = True
+		first = self.pool.submit(self.client().call, request(1, 'execute', {'command_id': 'A'}))
+		self.process_when_notified()
+		second = self.pool.submit(self.client().call, request(2, 'recall_view', {'view': 'Top'}))
+		self.process_when_notified()
+		self.assertEqual(self.calls, ['A'])
+		self.terminate()
+		self.assertEqual(first.result(5)['result'], 'Completed')
+		self.assertTrue(second.result(5)['result'])
+		self.assertEqual(self.calls, ['A', 'view Top'])
+
+	def test_command_that_does_not_terminate_times_out(self):
+		self.hold = True
+		reply = self.pool.submit(self.client().call, request(1, 'execute', {'command_id': 'A'}))
+		self.process_when_notified()
+		self.assertEqual(reply.result(5)['error']['code'], control_server.REQUEST_TIMEOUT)
+		# The queue goes on when it terminates after all
+		self.terminate()
+		self.assertIsNone(self.server.running)
+
+	def test_execute_is_never_coalesced(self):
+		client = self.client()
+		batch = [request(i, 'execute', {'command_id': 'RollForward'}) for i in range(3)]
+		reply = self.pool.submit(client.call, batch)
+		self.process_when_notified(3)
+		self.assertEqual([r['result'] for r in reply.result(5)], ['Completed'] * 3)
+		self.assertEqual(self.calls, ['RollForward'] * 3)
+
+	def test_recall_view_is_coalesced_between_requests_but_not_within_batch(self):
+		first = self.pool.submit(self.client().call, request(1, 'recall_view', {'view': 'Top'}))
+		self.assertTrue(self.notified.wait(5))
+		second = self.pool.submit(self.client().call, [request(2, 'recall_view', {'view': 'Top'}),
+													   request(3, 'recall_view', {'view': 'Top'})])
+		# The batch merges its first entry with the waiting request, the second entry is queued separately
+		deadline = time.time() + 5
+		while self.server.get_stats()['coalesced'] < 1 and time.time() < deadline: time.sleep(0.01)
+		self.process_when_notified(2)
+		self.assertTrue(first.result(5)['result'])
+		self.assertEqual([r['result'] for r in second.result(5)], [True, True])
+		self.assertEqual(self.calls, ['view Top', 'view Top'])
+
+	def test_back_pressure(self):
+		batch = [request(i, 'execute', {'command_id': str(i)}) for i in range(5)]
+		reply = self.pool.submit(self.client().call, batch)
+		self.process_when_notified(3)
+		errors = [r.get('error', {}).get('code') for r in reply.result(5)]
+		self.assertEqual(errors, [None, None, None, control_server.SERVER_BUSY, control_server.SERVER_BUSY])
+		self.assertEqual(self.calls, ['0', '1', '2'])
+
+	def test_timed_out_request_is_not_run(self):
+		reply = self.client().call(request(1, 'execute', {'command_id': 'Late'}))
+		self.assertEqual(reply['error']['code'], control_server.REQUEST_TIMEOUT)
+		self.server.process_pending()
+		self.assertEqual(self.calls, [])
+
+	def test_invalid_params(self):
+		reply = self.pool.submit(self.client().call, request(1, 'execute', {}))
+		self.process_when_notified()
+		self.assertEqual(reply.result(5)['error']['code'], control_server.INVALID_PARAMS)
+
+	def test_bad_token_closes_connection(self):
+		client = self.client()
+		reply = client.call(request(1, 'execute', {'command_id': 'A'}, token='wrong'))
+		self.assertEqual(reply['error']['code'], control_server.UNAUTHORIZED)
+		self.assertIsNone(client.call(request(2, 'ping')))
+		self.assertEqual(self.calls, [])
+
+	def test_http_request_is_rejected(self):
+		client = self.client()
+		body = json.dumps(request(1, 'execute', {'command_id': 'FusionDeleteCommand'})).encode('utf-8')
+		reply = client.send_raw(b'POST / HTTP/1.1\r\nOrigin: https://evil.example\r\n'
+								b'Content-Type: text/plain\r\n\r\n' + body + b'\n')
+		self.assertEqual(reply['error']['code'], control_server.PARSE_ERROR)
+		self.assertIsNone(client.file.readline() or None)
+		self.assertEqual(self.calls, [])
+
+	def test_failing_notify_does_not_block_later_requests(self):
+		failing = [True]
+		def notify():
+			if failing.pop(0) if failing else False: raise RuntimeError('No Fusion')
+			self.notified.set()
+		self.server.notify = notify
+		client = self.client()
+		self.assertEqual(client.call(request(1, 'execute', {'command_id': 'A'}))['error']['code'],
+						 control_server.INTERNAL_ERROR)
+		reply = self.pool.submit(client.call, request(2, 'execute', {'command_id': 'B'}))
+		self.process_when_notified()
+		self.assertEqual(reply.result(5)['result'], 'Completed')
+		self.assertEqual(self.calls, ['B'])
+
+	def test_stop_fails_pending_and_closes_clients(self):
+		client = self.client()
+		reply = self.pool.submit(client.call, request(1, 'execute', {'command_id': 'A'}))
+		self.assertTrue(self.notified.wait(5))
+		start = time.time()
+		self.server.stop()
+		self.assertLess(time.time() - start, 2)
+		self.assertEqual(reply.result(5)['error']['code'], control_server.INTERNAL_ERROR)
+		self.assertEqual(self.calls, [])
+
+	def test_stop_fails_running_command(self):
+		self.hold = True
+		reply = self.pool.submit(self.client().call, request(1, 'execute', {'command_id': 'A'}))
+		self.process_when_notified()
+		self.server.stop()
+		self.assertEqual(reply.result(5)['error']['code'], control_server.INTERNAL_ERROR)
+		self.terminate() # Too late, ignored
+
+	def test_stop_without_start(self):
+		server = self.make_server()
+		stopper = threading.Thread(target=server.stop, daemon=True)
+		stopper.start()
+		stopper.join(5)
+		self.assertFalse(stopper.is_alive())
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,244 @@
+# Headless tests for the toolbar reconciler, using fake toolbar objects that count
+# every API access. Run with: python -m unittest discover tests  (or python -m pytest tests)
+
+import os, sys, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import toolbar_reconcile
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class Api:
+	def __init__(self):
+		self.calls = 0
+		self.changes = 0 # Calls that modify the toolbar: add, delete and assignments
+
+class ApiObject:
+	'''Counts every public attribute access (method calls included) and assignment,
+	as each of them is a call across the Fusion API.'''
+	def __init__(self, api, **attrs):
+		object.__setattr__(self, '_api', api)
+		object.__setattr__(self, 'isValid', True)
+		for name, value in attrs.items(): object.__setattr__(self, name, value)
+
+	def __getattribute__(self, name):
+		if not name.startswith('_'): object.__getattribute__(self, '_api').calls += 1
+		return object.__getattribute__(self, name)
+
+	def __setattr__(self, name, value):
+		self._api.calls += 1
+		self._api.changes += 1
+		object.__setattr__(self, name, value)
+
+class Collection(ApiObject):
+	def __init__(self, api):
+		super().__init__(api)
+		object.__setattr__(self, '_items', [])
+
+	def itemById(self, item_id):
+		return next((item for item in self._items if item._id() == item_id), None)
+
+	@property
+	def count(self): return len(self._items)
+
+	def item(self, index): return self._items[index]
+
+	def __iter__(self):
+		# Fusion iterates with count and item()
+		self._api.calls += 1 + len(self._items)
+		return iter(list(self._items))
+
+	def _add(self, item, position_id='', is_before=True):
+		self._api.changes += 1
+		object.__setattr__(item, '_collection', self)
+		ids = self._ids()
+		if position_id in ids: self._items.insert(ids.index(position_id) + (0 if is_before else 1), item)
+		else: self._items.append(item)
+		return item
+
+	def _ids(self): return [item._id() for item in self._items]
+
+class Deletable(ApiObject):
+	def _id(self): return object.__getattribute__(self, 'id')
+
+	def deleteMe(self):
+		self._api.changes += 1
+		self._collection._items.remove(self)
+		object.__setattr__(self, 'isValid', False)
+		return True
+
+class ControlDefinition(ApiObject): pass
+
+class CommandDefinition(Deletable):
+	@property
+	def name(self): return self.controlDefinition.name # Read-only, like in Fusion
+
+class CommandDefinitions(Collection):
+	def addButtonDefinition(self, cmd_def_id, name, tooltip, resource_folder=''):
+		return self._add(CommandDefinition(self._api, id=cmd_def_id, tooltip=tooltip,
+										   resourceFolder=os.path.join(BASE_DIR, resource_folder),
+										   controlDefinition=ControlDefinition(self._api, name=name)))
+
+class ToolbarControls(Collection):
+	def addCommand(self, cmd_def, positionID='', isBefore=True):
+		return self._add(Deletable(self._api, id=cmd_def._id(), commandDefinition=cmd_def,
+								   isPromoted=False, isPromotedByDefault=False), positionID, isBefore)
+
+	def addDropDown(self, text, resource_folder, dropdown_id, positionID='', isBefore=True):
+		return self._add(Deletable(self._api, id=dropdown_id, name=text,
+								   resourceFolder=os.path.join(BASE_DIR, resource_folder),
+								   controls=ToolbarControls(self._api)), positionID, isBefore)
+
+	def addSeparator(self, separator_id='', positionID='', isBefore=True):
+		return self._add(Deletable(self._api, id=separator_id), positionID, isBefore)
+
+class ToolbarPanels(Collection):
+	def add(self, panel_id, name):
+		return self._add(Deletable(self._api, id=panel_id, name=name, isVisible=True,
+								   controls=ToolbarControls(self._api)))
+
+class UserInterface:
+	def __init__(self):
+		self.api = Api()
+		self.panels = ToolbarPanels(self.api)
+		self.commandDefinitions = CommandDefinitions(self.api)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# The same tree as AnyShortcut.run(), in short
+
+BUILTIN_COMMANDS = [(f'builtin{i}', f'Builtin {i}', './resources/repeat') for i in range(6)]
+VIEW_COMMANDS = [(f'view{i}', f'View {i}', './resources/viewfront') for i in range(10)]
+
+def reconcile(ui, texts=None, builtin_commands=BUILTIN_COMMANDS):
+	texts = texts or {}
+	reconciler = toolbar_reconcile.ToolbarReconciler(ui.commandDefinitions, BASE_DIR)
+	panel = reconciler.panel(ui.panels, 'panel', 'AnyShortcut')
+	builtin = reconciler.dropdown(panel, 'builtin', 'Built-in Commands', './resources/builtin')
+	for cmd_def_id, text, icon in builtin_commands:
+		reconciler.command(builtin, reconciler.button_definition(cmd_def_id, texts.get(cmd_def_id, text), '', icon))
+	views = reconciler.dropdown(builtin, 'views', 'View Orientation', './resources/viewfront')
+	for cmd_def_id, text, icon in VIEW_COMMANDS:
+		reconciler.command(views, reconciler.button_definition(cmd_def_id, text, '', icon))
+	for dropdown in (builtin, views): reconciler.prune(dropdown, delete_definitions=True)
+	tracking = reconciler.dropdown(panel, 'tracking', 'Command Recorder', './resources/tracker')
+	reconciler.prune(panel)
+	enable = reconciler.button_definition('enable', texts.get('enable', 'Start recording'), '', './resources/record')
+	reconciler.command(tracking, enable, promote=True)
+	reconciler.separator(tracking, 'separator')
+	reconciler.prune(tracking)
+	return reconciler
+
+def delete_and_recreate(ui):
+	# What run() did before the reconciler
+	def replace_definition(cmd_def_id, text, icon):
+		definition = ui.commandDefinitions.itemById(cmd_def_id)
+		if definition and definition.isValid: definition.deleteMe()
+		return ui.commandDefinitions.addButtonDefinition(cmd_def_id, text, '', icon)
+	def replace(item):
+		if item and item.isValid: item.deleteMe()
+	replace(ui.panels.itemById('panel'))
+	panel = ui.panels.add('panel', 'AnyShortcut')
+	replace(panel.controls.itemById('builtin'))
+	builtin = panel.controls.addDropDown('Built-in Commands', './resources/builtin', 'builtin')
+	for cmd_def_id, text, icon in BUILTIN_COMMANDS:
+		builtin.controls.addCommand(replace_definition(cmd_def_id, text, icon))
+	views = builtin.controls.addDropDown('View Orientation', './resources/viewfront', 'views')
+	for cmd_def_id, text, icon in VIEW_COMMANDS:
+		views.controls.addCommand(replace_definition(cmd_def_id, text, icon))
+	replace(panel.controls.itemById('tracking'))
+	tracking = panel.controls.addDropDown('Command Recorder', './resources/tracker', 'tracking')
+	enable = replace_definition('enable', 'Loading...', './resources/record')
+	enable.controlDefinition.name = 'Start recording'
+	control = tracking.controls.addCommand(enable)
+	control.isPromoted = True
+	control.isPromotedByDefault = True
+	tracking.controls.addSeparator()
+
+def cost_of(ui, build):
+	'''Returns the (API calls, changing API calls) of build(ui).'''
+	calls, changes = ui.api.calls, ui.api.changes
+	build(ui)
+	return ui.api.calls - calls, ui.api.changes - changes
+
+
+class ToolbarReconcilerTest(unittest.TestCase):
+	def test_first_load_adds_everything(self):
+		ui = UserInterface()
+		reconciler = reconcile(ui)
+		count = 1 + 2 * len(BUILTIN_COMMANDS) + 2 * len(VIEW_COMMANDS) + 2 + 1 + 3
+		self.assertEqual(reconciler.stats, {'added': count, 'updated': 0, 'removed': 0, 'kept': 0})
+		self.assertTrue(ui.panels.itemById('panel').controls.itemById('tracking').controls.itemById('enable').isPromoted)
+
+	def test_reload_reuses_everything(self):
+		ui = UserInterface()
+		reconcile(ui)
+		enable = ui.panels.itemById('panel').controls.itemById('tracking').controls.itemById('enable')
+		# The user unpins the button, which must survive the reload
+		object.__setattr__(enable, 'isPromoted', False)
+		reconciler = reconcile(ui)
+		self.assertEqual(reconciler.stats['added'] + reconciler.stats['updated'] + reconciler.stats['removed'], 0)
+		self.assertIs(ui.panels.itemById('panel').controls.itemById('tracking').controls.itemById('enable'), enable)
+		self.assertFalse(enable.isPromoted)
+
+	def test_renamed_definition_is_synced_through_control_definition(self):
+		ui = UserInterface()
+		reconcile(ui)
+		reconciler = reconcile(ui, {'enable': 'Stop recording', 'builtin0': 'Renamed'})
+		self.assertEqual(reconciler.stats['updated'], 2)
+		self.assertEqual(ui.commandDefinitions.itemById('enable').name, 'Stop recording')
+		self.assertEqual(ui.commandDefinitions.itemById('builtin0').name, 'Renamed')
+
+	def test_recorded_commands_are_pruned(self):
+		ui = UserInterface()
+		reconcile(ui)
+		tracking = ui.panels.itemById('panel').controls.itemById('tracking')
+		recorded = ui.commandDefinitions.addButtonDefinition('FusionSomeCommand', 'Some Command', '')
+		tracking.controls.addCommand(recorded)
+		reconciler = reconcile(ui)
+		self.assertEqual(reconciler.stats['removed'], 1)
+		self.assertEqual(tracking.controls._ids(), ['enable', 'separator'])
+
+	def test_missing_controls_are_added_at_their_position(self):
+		ui = UserInterface()
+		reconcile(ui)
+		panel = ui.panels.itemById('panel')
+		builtin = panel.controls.itemById('builtin')
+		expected = builtin.controls._ids()
+		builtin.controls.itemById('builtin0').deleteMe()
+		builtin.controls.itemById('builtin3').deleteMe()
+		tracking = panel.controls.itemById('tracking')
+		tracking.controls.itemById('enable').deleteMe()
+		reconciler = reconcile(ui)
+		self.assertEqual(reconciler.stats['added'], 3)
+		self.assertEqual(builtin.controls._ids(), expected)
+		self.assertEqual(tracking.controls._ids(), ['enable', 'separator'])
+
+	def test_pruned_builtins_lose_their_definitions(self):
+		ui = UserInterface()
+		reconcile(ui)
+		tracking = ui.panels.itemById('panel').controls.itemById('tracking')
+		tracking.controls.addCommand(ui.commandDefinitions.addButtonDefinition('FusionSomeCommand', 'Some Command', ''))
+		reconciler = reconcile(ui, builtin_commands=BUILTIN_COMMANDS[1:])
+		self.assertEqual(reconciler.stats['removed'], 3) # builtin0 control and definition, the recorded control
+		self.assertIsNone(ui.commandDefinitions.itemById('builtin0'))
+		self.assertIsNotNone(ui.commandDefinitions.itemById('builtin1'))
+		# Recorded commands are Fusion's, only their controls go
+		self.assertIsNotNone(ui.commandDefinitions.itemById('FusionSomeCommand'))
+
+	def test_reload_api_calls_compared_to_delete_and_recreate(self):
+		rebuilt = UserInterface()
+		delete_and_recreate(rebuilt)
+		reconciled = UserInterface()
+		reconcile(reconciled)
+		(before, before_changes), (after, after_changes) = cost_of(rebuilt, delete_and_recreate), cost_of(reconciled, reconcile)
+		print(f'Reload: delete-and-recreate {before} API calls ({before_changes} changing the toolbar), '
+			  f'reconcile {after} API calls ({after_changes} changing the toolbar)')
+		# Reconciling has to read back what is there, but an unchanged reload must not touch the toolbar
+		self.assertEqual(after_changes, 0)
+		self.assertGreater(before_changes, 0)
+		# Reading the controls of a dropdown in one pass keeps the reads in proportion
+		self.assertLess(after, 2 * before)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,150 @@
+# This file is part of AnyShortcut, a Fusion 360 add-in for assigning
+# shortcuts to the last run commands.
+#
+# Copyright (c) 2020 Thomas Axelsson
+#
+# See AnyShortcut.py for the license (MIT).
+
+# Reconciliation of our toolbar tree. Deleting and recreating the panel on every
+# reload makes Fusion rebuild the ToolsTab and forget what the user promoted/pinned,
+# so existing items are reused and only the differences are applied.
+#
+# This module does not import the Fusion API, so that it can be tested headless
+# against fake toolbar objects. tests/test_toolbar_reconcile.py also measures the
+# API calls of a reload, compared to the old delete-and-recreate.
+
+import os
+
+def lookup(collection, item_id):
+	# itemById() only hands back valid objects
+	return collection.itemById(item_id) or None
+
+
+class ToolbarReconciler:
+	'''Brings the toolbar in line with what run() asks for. Controls are placed under a
+	parent (panel or dropdown) one by one, and prune() then removes every control of that
+	parent that was not placed during this run. Missing controls are added at the position
+	they are placed in, not at the end of the parent.
+
+	The controls of a parent are read in one pass and the result is reused by the
+	following lookups and prune(), to keep down the number of Fusion API calls.'''
+	def __init__(self, command_definitions, base_dir):
+		self.command_definitions = command_definitions
+		self.base_dir = base_dir # Resource folders are relative to the add-in
+		self.existing = {} # parent id -> {control id: control} read from Fusion, kept up to date
+		self.placed = {} # parent id -> control ids placed in this run, in order
+		self.definition_ids = set() # Command definitions reconciled in this run
+		self.stats = {'added': 0, 'updated': 0, 'removed': 0, 'kept': 0}
+
+	def report(self):
+		s = self.stats
+		return f"{s['added']} added, {s['updated']} updated, {s['removed']} removed, {s['kept']} unchanged"
+
+	def record(self, existing, changed):
+		self.stats['added' if not existing else 'updated' if changed else 'kept'] += 1
+
+	def place(self, parent, control_id):
+		'''Marks control_id as wanted under parent. Returns (existing control or None, controls of parent,
+		(positionID, isBefore) to add the control with, to get it after the previously placed one).'''
+		parent_id = parent.id
+		if parent_id not in self.existing:
+			self.existing[parent_id] = {control.id: control for control in parent.controls}
+		existing = self.existing[parent_id]
+		placed = self.placed.setdefault(parent_id, [])
+		if placed: position = (placed[-1], False)
+		else: position = (next(iter(existing), ''), True) # First, so before anything that is there
+		placed.append(control_id)
+		return existing.get(control_id), existing, position
+
+	def same_path(self, a, b):
+		# Fusion hands back absolute resource folders, while we set them relative to the add-in.
+		def norm(p): return os.path.normcase(os.path.normpath(os.path.join(self.base_dir, p)))
+		return norm(a) == norm(b)
+
+	def sync(self, obj, **attrs):
+		'''Only assigns the attributes that differ. Returns True if anything was changed.'''
+		changed = False
+		for name, value in attrs.items():
+			try: current = getattr(obj, name)
+			except: current = None # resourceFolder throws when there is no icon
+			same = (current is not None and self.same_path(current, value)) if name == 'resourceFolder' else current == value
+			if not same:
+				setattr(obj, name, value)
+				changed = True
+		return changed
+
+	#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+	def panel(self, panels, panel_id, name):
+		panel = lookup(panels, panel_id)
+		if panel:
+			# stop() only hides the panel, to keep the controls (and their promoted state) around.
+			self.record(True, self.sync(panel, isVisible=True))
+		else:
+			panel = panels.add(panel_id, name)
+			self.existing[panel_id] = {}
+			self.record(False, True)
+		return panel
+
+	def dropdown(self, parent, dropdown_id, text, resource_folder):
+		dropdown, existing, position = self.place(parent, dropdown_id)
+		if dropdown:
+			self.record(True, self.sync(dropdown, name=text, resourceFolder=resource_folder))
+		else:
+			dropdown = existing[dropdown_id] = parent.controls.addDropDown(text, resource_folder, dropdown_id, *position)
+			self.existing[dropdown_id] = {} # Nothing to read back
+			self.record(False, True)
+		return dropdown
+
+	def button_definition(self, cmd_def_id, text, tooltip, resource_folder=''):
+		self.definition_ids.add(cmd_def_id)
+		cmd_def = lookup(self.command_definitions, cmd_def_id)
+		if cmd_def:
+			attrs = {'tooltip': tooltip}
+			if resource_folder: attrs['resourceFolder'] = resource_folder
+			# CommandDefinition.name is read-only, the name is set on the control definition
+			changed = self.sync(cmd_def, **attrs) | self.sync(cmd_def.controlDefinition, name=text)
+			self.record(True, changed)
+		else:
+			cmd_def = self.command_definitions.addButtonDefinition(cmd_def_id, text, tooltip, resource_folder)
+			self.record(False, True)
+		return cmd_def
+
+	def command(self, parent, cmd_def, promote=False):
+		'''`promote` is only applied when the control is created, to not override the user's choice on reload.'''
+		cmd_def_id = cmd_def.id
+		control, existing, position = self.place(parent, cmd_def_id)
+		self.record(control is not None, False)
+		if not control:
+			control = existing[cmd_def_id] = parent.controls.addCommand(cmd_def, *position)
+			if promote:
+				control.isPromoted = True
+				control.isPromotedByDefault = True
+		return control
+
+	def separator(self, parent, separator_id):
+		separator, existing, position = self.place(parent, separator_id)
+		self.record(separator is not None, False)
+		if not separator:
+			separator = existing[separator_id] = parent.controls.addSeparator(separator_id, *position)
+		return separator
+
+	def prune(self, parent, delete_definitions=False):
+		'''Removes the controls of parent that were not placed in this run. With `delete_definitions`,
+		the command definitions behind them are deleted as well, unless they are still in use. Only
+		use it for our own commands, not for recorded ones, which are Fusion's.'''
+		keep_ids = set(self.placed.get(parent.id, ()))
+		existing = self.existing.get(parent.id, {})
+		for control_id in [i for i in existing if i not in keep_ids]:
+			self.remove(existing.pop(control_id), delete_definitions)
+
+	def remove(self, control, delete_definitions):
+		definition = None
+		if delete_definitions:
+			# Separators and dropdowns have no command definition, dropdowns have controls instead
+			children = getattr(control, 'controls', None)
+			for child in (list(children) if children else ()): self.remove(child, True)
+			definition = getattr(control, 'commandDefinition', None)
+		if control.isValid and control.deleteMe(): self.stats['removed'] += 1
+		if definition and definition.id not in self.definition_ids and definition.isValid and definition.deleteMe():
+			self.stats['removed'] += 1
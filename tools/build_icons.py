@@ -0,0 +1,209 @@
+# This file is part of AnyShortcut, a Fusion 360 add-in for assigning
+# shortcuts to the last run commands.
+#
+# Copyright (c) 2020 Thomas Axelsson
+#
+# See AnyShortcut.py for the license (MIT).
+
+# Builds the command icons in resources/ from their SVGs.
+#
+# Every icon folder with a single SVG is rendered to 16x16.png and 32x32.png.
+# Folders that ship disabled variants get *-disabled.png copies, as the old
+# copy_normal_to_disabled.sh did. SVGs are hashed, so only changed icons are
+# rendered, and the rendering runs in a process pool.
+#
+# It also checks that every resource folder referenced from AnyShortcut.py exists
+# and has icons.
+#
+# Requires cairosvg (pip install cairosvg).
+#
+# Usage: python tools/build_icons.py [--force] [--check] [--jobs N]
+
+import argparse, ast, concurrent.futures, hashlib, json, os, shutil, sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+RESOURCES_DIR = os.path.join(ROOT_DIR, 'resources')
+ADDIN_FILE = os.path.join(ROOT_DIR, 'AnyShortcut.py')
+CACHE_FILE = os.path.join(RESOURCES_DIR, '.icon_cache.json')
+
+SIZES = (16, 32)
+# Folders that are not command icons
+SKIP_FOLDERS = {'bak', 'banner'}
+# Bump to invalidate the cache when the rendering changes
+CACHE_VERSION = 1
+
+def icon_names(size, disabled=False):
+	return f'{size}x{size}-disabled.png' if disabled else f'{size}x{size}.png'
+
+def find_icon_folders():
+	'''Returns {folder name: svg path} for all folders that have exactly one SVG.'''
+	folders = {}
+	for name in sorted(os.listdir(RESOURCES_DIR)):
+		path = os.path.join(RESOURCES_DIR, name)
+		if name in SKIP_FOLDERS or not os.path.isdir(path): continue
+		svgs = [f for f in os.listdir(path) if f.lower().endswith('.svg')]
+		if len(svgs) == 1: folders[name] = os.path.join(path, svgs[0])
+		elif len(svgs) > 1: print(f'Skipping {name}: more than one SVG', file=sys.stderr)
+	return folders
+
+def has_disabled(folder):
+	return any(os.path.exists(os.path.join(RESOURCES_DIR, folder, icon_names(size, True))) for size in SIZES)
+
+def content_hash(svg_path, disabled):
+	with open(svg_path, 'rb') as f:
+		digest = hashlib.sha256(f.read())
+	digest.update(f'{CACHE_VERSION}:{SIZES}:{disabled}'.encode())
+	return digest.hexdigest()
+
+def outputs_exist(folder, disabled):
+	names = [icon_names(size) for size in SIZES]
+	if disabled: names += [icon_names(size, True) for size in SIZES]
+	return all(os.path.exists(os.path.join(RESOURCES_DIR, folder, name)) for name in names)
+
+def render(folder, svg_path, disabled):
+	# Runs in a worker process
+	import cairosvg
+	folder_path = os.path.join(RESOURCES_DIR, folder)
+	for size in SIZES:
+		png_path = os.path.join(folder_path, icon_names(size))
+		cairosvg.svg2png(url=svg_path, write_to=png_path, output_width=size, output_height=size)
+		# Fusion greys out disabled commands by itself, the disabled icons are plain copies
+		if disabled: shutil.copyfile(png_path, os.path.join(folder_path, icon_names(size, True)))
+	return folder
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class UnresolvedFolderError(Exception): pass
+
+def module_constants(tree):
+	constants = {}
+	for node in tree.body:
+		if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+			try: constants[node.targets[0].id] = ast.literal_eval(node.value)
+			except ValueError:
+				# Iterating a dict only needs its keys, the values may be anything
+				if isinstance(node.value, ast.Dict) and all(isinstance(k, ast.Constant) for k in node.value.keys):
+					constants[node.targets[0].id] = [k.value for k in node.value.keys]
+	return constants
+
+class FolderCollector(ast.NodeVisitor):
+	'''Collects './resources/...' strings. Folders built as PREFIX + var or PREFIX + var.lower()
+	are expanded over the iterable of the enclosing `for var in ...` loop. Anything else that
+	builds a resource folder cannot be checked and raises UnresolvedFolderError.'''
+	PREFIX = './resources/'
+
+	def __init__(self, constants):
+		self.constants = constants
+		self.loops = [] # Stack of (variable name, values)
+		self.folders = set()
+
+	def visit_For(self, node):
+		self.visit(node.iter)
+		values = None
+		if isinstance(node.target, ast.Name):
+			try: values = ast.literal_eval(node.iter)
+			except ValueError:
+				if isinstance(node.iter, ast.Name): values = self.constants.get(node.iter.id)
+		self.loops.append((node.target.id if isinstance(node.target, ast.Name) else None, values))
+		for child in node.body + node.orelse: self.visit(child)
+		self.loops.pop()
+
+	def visit_BinOp(self, node):
+		prefix = node.left.value if isinstance(node.left, ast.Constant) and isinstance(node.left.value, str) else None
+		if not (isinstance(node.op, ast.Add) and prefix and prefix.startswith(self.PREFIX)):
+			return self.generic_visit(node)
+		self.visit(node.right)
+		self.folders.update(prefix[len(self.PREFIX):] + value for value in self.resolve(node.right))
+
+	def visit_Constant(self, node):
+		if isinstance(node.value, str) and node.value.startswith(self.PREFIX):
+			self.folders.add(node.value[len(self.PREFIX):])
+
+	def resolve(self, expr):
+		lower = (isinstance(expr, ast.Call) and isinstance(expr.func, ast.Attribute)
+				 and expr.func.attr == 'lower' and not expr.args)
+		name = expr.func.value if lower else expr
+		if isinstance(name, ast.Name):
+			for variable, values in reversed(self.loops):
+				if variable == name.id:
+					if not isinstance(values, (list, tuple, dict)): break
+					return [str(value).lower() if lower else str(value) for value in values]
+		raise UnresolvedFolderError(f'{ADDIN_FILE}:{expr.lineno}: cannot resolve the resource folder '
+									f'expression "{ast.unparse(expr)}"')
+
+def referenced_folders():
+	'''Finds the resource folders used in AnyShortcut.py.'''
+	with open(ADDIN_FILE, encoding='utf-8') as f:
+		tree = ast.parse(f.read(), ADDIN_FILE)
+	collector = FolderCollector(module_constants(tree))
+	collector.visit(tree)
+	return collector.folders
+
+def check_referenced(icon_folders):
+	missing = []
+	for folder in sorted(referenced_folders()):
+		path = os.path.join(RESOURCES_DIR, folder)
+		if not os.path.isdir(path):
+			missing.append(f'{folder}: folder does not exist')
+		elif folder not in icon_folders and not os.path.exists(os.path.join(path, icon_names(16))):
+			missing.append(f'{folder}: no SVG or {icon_names(16)}')
+	return missing
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def load_cache():
+	try:
+		with open(CACHE_FILE, encoding='utf-8') as f: return json.load(f)
+	except (OSError, ValueError): return {}
+
+def save_cache(cache):
+	with open(CACHE_FILE, 'w', encoding='utf-8') as f:
+		json.dump(cache, f, indent=1, sort_keys=True)
+
+def main():
+	parser = argparse.ArgumentParser(description='Builds the AnyShortcut icons from the SVGs in resources/.')
+	parser.add_argument('--force', action='store_true', help='Render all icons, ignoring the cache')
+	parser.add_argument('--check', action='store_true', help='Only check the referenced resource folders')
+	parser.add_argument('--jobs', type=int, default=None, help='Number of worker processes')
+	args = parser.parse_args()
+
+	icon_folders = find_icon_folders()
+	try: missing = check_referenced(icon_folders)
+	except UnresolvedFolderError as e:
+		print(f'Error: {e}', file=sys.stderr)
+		return 1
+	for problem in missing: print(f'Missing icon: {problem}', file=sys.stderr)
+	if args.check: return 1 if missing else 0
+
+	cache = {} if args.force else load_cache()
+	todo = {}
+	for folder, svg_path in icon_folders.items():
+		disabled = has_disabled(folder)
+		digest = content_hash(svg_path, disabled)
+		if cache.get(folder) == digest and outputs_exist(folder, disabled): continue
+		todo[folder] = (svg_path, disabled, digest)
+
+	print(f'{len(todo)} of {len(icon_folders)} icons changed')
+	if todo:
+		try: import cairosvg
+		except ImportError:
+			print('Error: cairosvg is needed to render icons (pip install cairosvg)', file=sys.stderr)
+			return 1
+	failed = False
+	with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+		futures = {pool.submit(render, folder, svg_path, disabled): folder
+				   for folder, (svg_path, disabled, digest) in todo.items()}
+		for future in concurrent.futures.as_completed(futures):
+			folder = futures[future]
+			try: future.result()
+			except Exception as e:
+				print(f'Failed to render {folder}: {e}', file=sys.stderr)
+				failed = True
+				continue
+			cache[folder] = todo[folder][2]
+			print(f'Rendered {folder}')
+	save_cache(cache)
+	return 1 if failed or missing else 0
+
+if __name__ == '__main__':
+	sys.exit(main())